@@ -0,0 +1,201 @@
+"""
+Encoding and decoding of the frames that compact Arduino probes write to the
+serial port.  This module does not use the sublime API, so that it can be
+tested on its own.
+
+A frame is FRAME_MAGIC, the probe id as a varint, then for every expression of
+the probe the size of its value (one byte, up to MAX_VALUE_SIZE) and the raw
+bytes of the value, and last a checksum byte: the sum of the bytes between the
+magic and the checksum, modulo 256.  The probe id refers to the probe table
+that is kept by the plugin.  Text that is printed to the serial port never
+contains a NUL byte, so that is what starts the magic.
+"""
+import binascii
+import struct
+
+FRAME_MAGIC = b'\x00\xA5'
+MAX_VALUE_SIZE = 127
+# probe ids are up to 32 bits
+MAX_VARINT_SIZE = 5
+
+
+def encode_varint(number):
+    encoded = bytearray()
+    while number > 0x7F:
+        encoded.append(0x80 | (number & 0x7F))
+        number >>= 7
+    encoded.append(number)
+    return bytes(encoded)
+
+
+def decode_varint(data, offset):
+    """
+    Returns the varint at ``offset`` and the offset after it, ``None`` if
+    ``data`` ends in the middle of it, or ``False`` if it is too long to be a
+    varint that was written by a probe.
+    """
+    number = 0
+    for index in range(MAX_VARINT_SIZE):
+        if offset + index >= len(data):
+            return None
+        byte = data[offset + index]
+        number |= (byte & 0x7F) << (7 * index)
+        if not byte & 0x80:
+            return number, offset + index + 1
+    return False
+
+
+def checksum(data):
+    return sum(bytearray(data)) & 0xFF
+
+
+def encode_frame(probe_id, values):
+    """
+    Returns the frame that a probe writes for the raw bytes of its ``values``.
+    """
+    body = encode_varint(probe_id)
+    for value in values:
+        body += bytes([len(value)]) + value
+    return FRAME_MAGIC + body + bytes([checksum(body)])
+
+
+def format_value(raw):
+    """
+    The type of the value is not known, so it is shown as a little endian
+    integer, and as a float when it has the size of one.
+    """
+    if not raw or len(raw) > 8:
+        return '0x' + binascii.hexlify(raw).decode('ascii')
+    value = str(int.from_bytes(raw, 'little', signed=True))
+    if len(raw) in (4, 8):
+        value += ' / {0:g}'.format(struct.unpack('<f' if len(raw) == 4 else '<d', raw)[0])
+    return value
+
+
+def incomplete_utf8(data):
+    """
+    Returns the number of bytes of the incomplete UTF-8 character at the end
+    of ``data``, if any.
+    """
+    for size in range(1, min(3, len(data)) + 1):
+        byte = data[-size]
+        if byte & 0xC0 == 0x80:
+            continue
+        # the first byte tells the length: 110xxxxx, 1110xxxx or 11110xxx
+        if byte >= 0xF0:
+            length = 4
+        elif byte >= 0xE0:
+            length = 3
+        elif byte >= 0xC0:
+            length = 2
+        else:
+            length = 1
+        return size if size < length else 0
+    return 0
+
+
+def decode_frame(data, offset, probes):
+    """
+    Returns the record of the frame at ``offset`` and the offset after it,
+    ``None`` if ``data`` ends in the middle of the frame, or ``False`` if this
+    is not a valid frame of a known probe.  The size of every value is
+    checked before it is waited for, so an incomplete frame is never longer
+    than the largest frame of its probe.
+    """
+    magic = data[offset:offset + len(FRAME_MAGIC)]
+    if not FRAME_MAGIC.startswith(magic):
+        return False
+    if len(magic) < len(FRAME_MAGIC):
+        return None
+    start = offset + len(FRAME_MAGIC)
+    decoded = decode_varint(data, start)
+    if not decoded:
+        # incomplete, or not a varint
+        return decoded
+    probe_id, offset = decoded
+    probe = probes.get(str(probe_id))
+    if probe is None:
+        return False
+
+    values = []
+    for _ in probe['expressions']:
+        if offset >= len(data):
+            return None
+        size = data[offset]
+        if not 0 < size <= MAX_VALUE_SIZE:
+            return False
+        offset += 1
+        if offset + size > len(data):
+            return None
+        values.append(data[offset:offset + size])
+        offset += size
+
+    if offset >= len(data):
+        return None
+    if data[offset] != checksum(data[start:offset]):
+        return False
+
+    record = '=========== {0} at line {1} ===========\n'.format(probe['file'], probe['line'])
+    for expression, value in zip(probe['expressions'], values):
+        record += '{0} = {1}\n'.format(expression, format_value(value))
+    return record, offset + 1
+
+
+def decode_stream(data, probes, final=False):
+    """
+    Decodes the frames in ``data`` using the ``probes`` of the probe table.
+    Returns the decoded text and the number of bytes that were consumed.  The
+    bytes between frames (other serial output) are kept as they are.
+
+    Unless this is the ``final`` part of the stream, a frame (or character)
+    that is incomplete at the end of ``data`` is left over, so that it can be
+    decoded along with the bytes that follow it.  Bytes that look like the
+    start of a frame, but are not a valid one (binary data written by the
+    sketch, or a capture that starts in the middle of a frame), are skipped
+    one at a time, so the next frame is still found.
+    """
+    output = ''
+    offset = 0
+    text_start = 0
+    while True:
+        start = data.find(FRAME_MAGIC[:1], offset)
+        if start < 0:
+            offset = len(data)
+            if not final:
+                # a character that is split at the end is left over, too
+                offset -= incomplete_utf8(data)
+            break
+
+        frame = decode_frame(data, start, probes)
+        if frame is None:
+            if not final:
+                offset = start
+                break
+            output += data[text_start:start].decode('utf-8', errors='replace')
+            output += '=========== incomplete frame at the end ===========\n'
+            return output, len(data)
+        if frame is False:
+            offset = start + 1
+            continue
+
+        record, offset = frame
+        output += data[text_start:start].decode('utf-8', errors='replace')
+        output += record
+        text_start = offset
+
+    output += data[text_start:offset].decode('utf-8', errors='replace')
+    return output, offset
+
+
+def decode_chunks(chunks, probes):
+    """
+    Decodes a stream that is read in ``chunks``, and returns the text.
+    """
+    output = ''
+    rest = b''
+    for chunk in chunks:
+        data = rest + chunk
+        text, consumed = decode_stream(data, probes)
+        output += text
+        rest = data[consumed:]
+    return output + decode_stream(rest, probes, final=True)[0]
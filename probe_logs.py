@@ -0,0 +1,84 @@
+"""
+Counting the probe banners in a log of probe output, for the heatmap.  This
+module does not use the sublime API, so that it can be tested on its own.
+"""
+import os
+import re
+import zlib
+
+# the banners of the language commands, e.g. "=========== foo.py at line 12 ==========="
+# or "=========== foo.rb line 12 ===========" (objc adds ":<function>" to the name)
+BANNER_RE = re.compile(br'=========== ([^\n]+?) (?:at )?line (\d+) ===========')
+CHUNK_SIZE = 1024 * 1024
+# lines longer than a chunk are skipped, except for enough to find a banner
+LINE_TAIL = 4096
+# the bytes before the cached offset that are checked, in case the log was
+# rewritten in place
+CHECK_SIZE = 4096
+
+# path => {'identity': ..., 'offset': ..., 'check': ..., 'counts': {(name, line): hits}}
+hits_cache = {}
+
+
+def banner_name(name):
+    directory, _, base = name.decode('utf-8', errors='replace').replace('\\', '/').rpartition('/')
+    # objc banners are "<file>:<function>"
+    base = base.split(':', 1)[0]
+    return directory + '/' + base if directory else base
+
+
+def count_probe_hits(f, offset, counts, chunk_size=CHUNK_SIZE):
+    """
+    Counts the banners in the binary file ``f``, starting at ``offset``, into
+    ``counts``.  The file is read in chunks, and only complete lines are
+    counted; returns the offset after the last complete line, where the next
+    call should continue.
+    """
+    f.seek(offset)
+    rest = b''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+
+        data = rest + chunk
+        end = data.rfind(b'\n') + 1
+        for match in BANNER_RE.finditer(data, 0, end):
+            key = (banner_name(match.group(1)), int(match.group(2)))
+            counts[key] = counts.get(key, 0) + 1
+
+        rest = data[end:]
+        offset += end
+        if len(rest) > max(chunk_size, LINE_TAIL):
+            offset += len(rest) - LINE_TAIL
+            rest = rest[-LINE_TAIL:]
+    return offset
+
+
+def check_hits_offset(f, offset):
+    """
+    Returns a checksum of the bytes before ``offset`` in the binary file ``f``.
+    """
+    start = max(0, offset - CHECK_SIZE)
+    f.seek(start)
+    return zlib.crc32(f.read(offset - start))
+
+
+def probe_hits(path, chunk_size=CHUNK_SIZE):
+    """
+    Returns the hit counts of the probes in the log at ``path``.  The counts
+    are cached along with the offset that was read up to, so that only new
+    output is read the next time (unless the log was replaced, truncated, or
+    the bytes before the offset changed).
+    """
+    stat = os.stat(path)
+    identity = (stat.st_dev, stat.st_ino)
+    with open(path, 'rb') as f:
+        cached = hits_cache.get(path)
+        if not cached or cached['identity'] != identity or cached['offset'] > stat.st_size \
+                or check_hits_offset(f, cached['offset']) != cached['check']:
+            cached = hits_cache[path] = {'identity': identity, 'offset': 0, 'counts': {}}
+
+        cached['offset'] = count_probe_hits(f, cached['offset'], cached['counts'], chunk_size)
+        cached['check'] = check_hits_offset(f, cached['offset'])
+    return cached['counts']
@@ -0,0 +1,101 @@
+import json
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import arduino_frames  # noqa: E402
+
+
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures')
+RECORD = '''=========== sketch.ino at line 3 ===========
+x = 1 / 1.4013e-45
+f = 1075838976 / 2.5
+big = -300 / nan
+'''
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+def decode(data, probes, chunk_size=None):
+    chunk_size = chunk_size or len(data) or 1
+    return arduino_frames.decode_chunks([data[i:i + chunk_size] for i in range(0, len(data), chunk_size)], probes)
+
+
+class TestArduinoFrames(unittest.TestCase):
+    def setUp(self):
+        # serial_dump.bin was written by the compact probe in
+        # arduino_probes.json, with "boot: 5¥" and "tick" printed around it
+        self.dump = fixture('serial_dump.bin')
+        self.probes = json.loads(fixture('arduino_probes.json').decode('utf-8'))['probes']
+
+    def test_varint_round_trip(self):
+        for number in (0, 1, 127, 128, 300, 2 ** 21, 2 ** 32 - 1):
+            encoded = arduino_frames.encode_varint(number)
+            self.assertEqual(arduino_frames.decode_varint(encoded, 0), (number, len(encoded)))
+            self.assertIsNone(arduino_frames.decode_varint(encoded[:-1], 0))
+        self.assertFalse(arduino_frames.decode_varint(b'\xff' * 6, 0))
+
+    def test_frame_round_trip(self):
+        probes = {'300': {'file': 'a.ino', 'line': 7, 'expressions': ['a', 'b']}}
+        frame = arduino_frames.encode_frame(300, [b'\x01\x00', b'\xff'])
+        self.assertEqual(decode(b'before\n' + frame + b'after\n', probes),
+                         'before\n=========== a.ino at line 7 ===========\na = 1\nb = -1\nafter\n')
+
+    def test_recorded_dump(self):
+        self.assertEqual(decode(self.dump, self.probes), 'boot: 5¥\n' + (RECORD + 'tick\n') * 3)
+
+    def test_frame_split_across_chunks(self):
+        expected = decode(self.dump, self.probes)
+        for chunk_size in range(1, len(self.dump)):
+            self.assertEqual(decode(self.dump, self.probes, chunk_size), expected, chunk_size)
+
+    def test_character_split_across_chunks(self):
+        split = self.dump.index('¥'.encode('utf-8')) + 1
+        self.assertEqual(arduino_frames.decode_chunks([self.dump[:split], self.dump[split:]], self.probes),
+                         decode(self.dump, self.probes))
+
+    def test_unknown_probe_id(self):
+        output = decode(self.dump, {})
+        self.assertNotIn('===========', output)
+        self.assertTrue(output.startswith('boot: 5¥\n'))
+        self.assertEqual(output.count('tick\n'), 3)
+
+    def test_capture_starts_mid_frame(self):
+        first = self.dump.index(arduino_frames.FRAME_MAGIC)
+        second = self.dump.index(arduino_frames.FRAME_MAGIC, first + 1)
+        for start in range(first + 1, second):
+            output = decode(self.dump[start:], self.probes)
+            self.assertEqual(output.count('===========') // 2, 2, start)
+            self.assertTrue(output.endswith((RECORD + 'tick\n') * 2), start)
+
+    def test_bogus_size(self):
+        body = arduino_frames.encode_varint(1) + b'\xc8'
+        bogus = arduino_frames.FRAME_MAGIC + body + b'\x00' * 200
+        output = decode(bogus + self.dump, self.probes)
+        self.assertTrue(output.endswith('boot: 5¥\n' + (RECORD + 'tick\n') * 3))
+        self.assertNotIn('incomplete', output)
+
+    def test_checksum_mismatch(self):
+        frame = bytearray(self.dump[self.dump.index(arduino_frames.FRAME_MAGIC):self.dump.index(b'tick')])
+        frame[-1] ^= 0xFF
+        self.assertNotIn('===========', decode(bytes(frame), self.probes))
+
+    def test_incomplete_frame_at_the_end(self):
+        end = self.dump.index(b'tick')
+        self.assertEqual(decode(self.dump[:end - 1], self.probes),
+                         'boot: 5¥\n=========== incomplete frame at the end ===========\n')
+
+    def test_format_value(self):
+        self.assertEqual(arduino_frames.format_value(b'\x2a\x00'), '42')
+        self.assertEqual(arduino_frames.format_value(b'\x00\x00\x20\x40'), '1075838976 / 2.5')
+        self.assertEqual(arduino_frames.format_value(b'\x01' * 9), '0x010101010101010101')
+
+
+if __name__ == '__main__':
+    unittest.main()
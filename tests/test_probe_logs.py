@@ -0,0 +1,111 @@
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import probe_logs  # noqa: E402
+
+
+LOG = (
+    b'=========== foo.py at line 12 ===========\n'
+    b'x: 1\n'
+    b'=========== foo.rb line 3 ===========\n'
+    b'=========== Foo.m:-[Foo bar] at line 7 ===========\n'
+    b'=========== src/foo.py at line 12 ===========\n'
+    b'=========== foo.py at line 12 ===========\n'
+)
+COUNTS = {('foo.py', 12): 2, ('foo.rb', 3): 1, ('Foo.m', 7): 1, ('src/foo.py', 12): 1}
+
+
+def count(data, chunk_size, offset=0):
+    counts = {}
+    offset = probe_logs.count_probe_hits(io.BytesIO(data), offset, counts, chunk_size)
+    return counts, offset
+
+
+class TestCountProbeHits(unittest.TestCase):
+    def test_banners(self):
+        self.assertEqual(count(LOG, probe_logs.CHUNK_SIZE), (COUNTS, len(LOG)))
+
+    def test_chunks_smaller_than_a_line(self):
+        for chunk_size in range(1, len(LOG) + 1):
+            self.assertEqual(count(LOG, chunk_size), (COUNTS, len(LOG)), chunk_size)
+
+    def test_incomplete_line_is_left_over(self):
+        data = LOG + b'=========== foo.py at line 12 ====='
+        self.assertEqual(count(data, 7), (COUNTS, len(LOG)))
+
+    def test_line_longer_than_a_chunk(self):
+        data = b'x' * (probe_logs.LINE_TAIL * 5) + LOG
+        for chunk_size in (100, probe_logs.LINE_TAIL, probe_logs.LINE_TAIL * 3):
+            self.assertEqual(count(data, chunk_size), (COUNTS, len(data)), chunk_size)
+
+    def test_resume_from_offset(self):
+        counts, offset = count(LOG, 5)
+        more = b'=========== foo.rb line 3 ===========\n'
+        data = LOG + more
+        resumed = dict(counts)
+        offset = probe_logs.count_probe_hits(io.BytesIO(data), offset, resumed, 5)
+        self.assertEqual(offset, len(data))
+        self.assertEqual(resumed, count(data, 5)[0])
+
+
+class TestProbeHits(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'probes.log')
+        probe_logs.hits_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, data, mode='wb'):
+        with open(self.path, mode) as f:
+            f.write(data)
+
+    def test_reads_only_new_output(self):
+        self.write(LOG + b'=========== foo.rb li')
+        self.assertEqual(probe_logs.probe_hits(self.path, 8), COUNTS)
+        self.assertEqual(probe_logs.hits_cache[self.path]['offset'], len(LOG))
+
+        self.write(b'ne 3 ===========\n', 'ab')
+        expected = dict(COUNTS)
+        expected[('foo.rb', 3)] += 1
+        self.assertEqual(probe_logs.probe_hits(self.path, 8), expected)
+
+    def test_log_rewritten_in_place(self):
+        self.write(LOG)
+        probe_logs.probe_hits(self.path)
+        identity = probe_logs.hits_cache[self.path]['identity']
+
+        rewritten = b'=========== bar.py at line 1 ===========\n' * 10
+        self.assertGreater(len(rewritten), len(LOG))
+        self.write(rewritten)
+        self.assertEqual(probe_logs.hits_cache[self.path]['identity'], identity)
+        self.assertEqual(probe_logs.probe_hits(self.path), {('bar.py', 1): 10})
+
+    def test_log_truncated(self):
+        self.write(LOG)
+        probe_logs.probe_hits(self.path)
+        self.write(b'=========== bar.py at line 1 ===========\n')
+        self.assertEqual(probe_logs.probe_hits(self.path), {('bar.py', 1): 1})
+
+    def test_log_replaced(self):
+        self.write(LOG)
+        probe_logs.probe_hits(self.path)
+        replacement = os.path.join(self.directory, 'new.log')
+        with open(replacement, 'wb') as f:
+            f.write(LOG + b'=========== bar.py at line 1 ===========\n')
+        os.replace(replacement, self.path)
+        expected = dict(COUNTS)
+        expected[('bar.py', 1)] = 1
+        self.assertEqual(probe_logs.probe_hits(self.path), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,11 +2,20 @@
 import re
 import os
 import json
+import heapq
+import shutil
+import tempfile
+import threading
+import traceback
+import zlib
 from functools import cmp_to_key
 
 import sublime
 import sublime_plugin
 
+from .arduino_frames import FRAME_MAGIC, MAX_VALUE_SIZE, checksum, decode_chunks, encode_varint
+from .probe_logs import probe_hits
+
 
 def indent_at(view, region):
     line_start = view.line(region).begin()
@@ -14,6 +23,528 @@ def indent_at(view, region):
     return view.substr(sublime.Region(line_start, line_start + line_indent))
 
 
+# buffered probes append records to a buffer that is local to the thread, and
+# flush them in batches (or at exit) to a file per thread in buffer_dir().
+# Each record is a line "<monotonic ns>\t<thread id>\t<message>", where the
+# message has its backslashes and newlines escaped.
+BUFFER_SIZE = 256
+# java writes a file per thread and probe, so merging opens them in batches
+MERGE_OPEN_FILES = 64
+
+PYTHON_BUFFERED_PROBE = r"""import atexit, builtins, itertools, os, threading, time
+local = threading.local()
+buffers = []
+# thread idents are reused, so every buffer gets a file of its own
+counter = itertools.count()
+
+def flush(buffer):
+    lines, buffer['lines'] = buffer['lines'], []
+    if lines:
+        os.makedirs(os.path.dirname(buffer['path']), exist_ok=True)
+        with open(buffer['path'], 'a') as f:
+            f.writelines(lines)
+
+def probe(message):
+    buffer = getattr(local, 'buffer', None)
+    if buffer is None:
+        tid = threading.get_ident()
+        buffer = local.buffer = {'tid': tid, 'path': os.path.join(BUFFER_DIR, '%d-%d-%d.log' % (os.getpid(), tid, next(counter))), 'lines': []}
+        buffers.append(buffer)
+    buffer['lines'].append('%d\t%d\t%s\n' % (time.monotonic_ns(), buffer['tid'], message.replace('\\', '\\\\').replace('\n', '\\n')))
+    if len(buffer['lines']) >= BUFFER_SIZE:
+        flush(buffer)
+
+atexit.register(lambda: [flush(buffer) for buffer in buffers])
+builtins._text_debugging_probe = probe
+"""
+
+# thread object ids are reused, so the file of a buffer is also named after the
+# time that it was created
+RUBY_BUFFERED_PROBE = r"""(Thread.current.thread_variable_get(:text_debugging_probe) || Thread.current.thread_variable_set(:text_debugging_probe, proc { |lines = [], path = File.join(BUFFER_DIR, "#{Process.pid}-#{Thread.current.object_id}-#{Process.clock_gettime(Process::CLOCK_MONOTONIC, :nanosecond)}.log"), flush = nil|
+    flush = -> {
+        unless lines.empty?
+            require 'fileutils'
+            FileUtils.mkdir_p(File.dirname(path))
+            File.open(path, 'a') { |f| f.write(lines.join) }
+        end
+        lines.clear
+    }
+    at_exit { flush.() }
+    ->(message) {
+        lines << "#{Process.clock_gettime(Process::CLOCK_MONOTONIC, :nanosecond)}\t#{Thread.current.object_id}\t#{Array(message).join("\n").gsub("\\") { "\\\\" }.gsub("\n") { "\\n" }}\n"
+        flush.() if lines.size >= BUFFER_SIZE
+    }
+}.call)).call"""
+
+# the buffer of a java probe is a static field of a local class, which needs
+# Java 16; the class name is unique, and so is the file of every thread.
+JAVA_BUFFERED_PROBE = r"""{
+    class _TdProbe {
+        static final ThreadLocal<java.util.function.Consumer<String>> buffer = ThreadLocal.withInitial(() -> {
+            java.util.List<String> _tdLines = new java.util.ArrayList<>();
+            java.nio.file.Path _tdPath = java.nio.file.Paths.get(BUFFER_DIR, ProcessHandle.current().pid() + "-" + Thread.currentThread().getId() + "-" + _TdProbe.class.getName() + ".log");
+            Runnable _tdFlush = () -> {
+                synchronized (_tdLines) {
+                    try {
+                        java.nio.file.Files.createDirectories(_tdPath.getParent());
+                        java.nio.file.Files.write(_tdPath, _tdLines, java.nio.file.StandardOpenOption.CREATE, java.nio.file.StandardOpenOption.APPEND);
+                    } catch (java.io.IOException _tdError) {
+                    }
+                    _tdLines.clear();
+                }
+            };
+            Runtime.getRuntime().addShutdownHook(new Thread(_tdFlush));
+            return _tdMessage -> {
+                synchronized (_tdLines) {
+                    _tdLines.add(System.nanoTime() + "\t" + Thread.currentThread().getId() + "\t" + _tdMessage.replace("\\", "\\\\").replace("\n", "\\n"));
+                    if (_tdLines.size() >= BUFFER_SIZE) _tdFlush.run();
+                }
+            };
+        });
+    }
+    _TdProbe.buffer.get().accept(MESSAGE);
+}"""
+
+def buffer_dir(view=None):
+    directory = view and view.settings().get('text_debugging_buffer_dir')
+    return directory or os.path.join(tempfile.gettempdir(), 'text_debugging')
+
+
+def buffered_probe(view, template, tab='    ', quote=json.dumps, **values):
+    """
+    Fills in the buffer directory and batch size of a buffered probe template
+    (and any other ``values``), and re-indents it using ``tab``.
+    """
+    buffer_size = view.settings().get('text_debugging_buffer_size') or BUFFER_SIZE
+    return fill_template(template, tab, BUFFER_DIR=quote(buffer_dir(view)), BUFFER_SIZE=buffer_size, **values)
+
+
+def escape_record(message):
+    return message.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def unescape_record(message):
+    return re.sub(r'\\(.)', lambda match: '\n' if match.group(1) == 'n' else match.group(1), message)
+
+
+def read_buffered_records(path):
+    """
+    Yields the ``(timestamp, thread, message)`` records of one buffer file.
+    The records of a thread are flushed in order, so they are already sorted.
+    """
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t', 2)
+            if len(parts) != 3 or not parts[0].isdigit():
+                continue
+            yield int(parts[0]), parts[1], unescape_record(parts[2])
+
+
+def merge_buffered_records(paths, scratch):
+    """
+    Yields the records of the buffer files at ``paths``, merged in timestamp
+    order.  At most MERGE_OPEN_FILES are open at once: while there are more,
+    batches of them are merged into files in the ``scratch`` directory first.
+    """
+    paths = list(paths)
+    while len(paths) > MERGE_OPEN_FILES:
+        merged = []
+        for index in range(0, len(paths), MERGE_OPEN_FILES):
+            path = os.path.join(scratch, '{0}.log'.format(len(os.listdir(scratch))))
+            with open(path, 'w', encoding='utf-8') as f:
+                for timestamp, thread, message in heapq.merge(*[read_buffered_records(batch_path) for batch_path in paths[index:index + MERGE_OPEN_FILES]]):
+                    f.write('{0}\t{1}\t{2}\n'.format(timestamp, thread, escape_record(message)))
+            merged.append(path)
+        paths = merged
+
+    for record in heapq.merge(*[read_buffered_records(path) for path in paths]):
+        yield record
+
+
+# change-only probes remember a hash of the last value (or the value itself,
+# where there is no cheap hash) per site, and only print it when it differs;
+# every UNCHANGED_EVERY hits without a change they print "unchanged ×N".  The
+# repeats since the last of those are printed before the new value.
+UNCHANGED_EVERY = 100
+
+PYTHON_CHANGE_HELPER = r"""import builtins
+last = {}
+
+def change(site, value):
+    text = repr(value)
+    seen = last.get(site)
+    if seen is None or seen[0] != hash(text):
+        last[site] = [hash(text), 0]
+        message = '%s: %s' % (site, text)
+        if seen is not None and seen[1] % EVERY:
+            message = '%s: unchanged ×%d\n%s' % (site, seen[1], message)
+        return message
+    seen[1] += 1
+    if seen[1] % EVERY == 0:
+        return '%s: unchanged ×%d' % (site, seen[1])
+
+builtins._text_debugging_change = change
+"""
+
+PYTHON_CHANGE_PROBE = r"""(lambda message: message and PUTS(message))((getattr(__import__('builtins'), '_text_debugging_change', None) or exec(HELPER, {}) or __import__('builtins')._text_debugging_change)(SITE, (VALUE)))"""
+
+RUBY_CHANGE_PROBE = r"""($text_debugging_change ||= proc { |last = {}|
+    ->(site, value; text, seen, message) {
+        text = value.inspect
+        seen = last[site]
+        if seen.nil? || seen[0] != text.hash
+            last[site] = [text.hash, 0]
+            message = "#{site}: #{text}"
+            seen && seen[1] % EVERY != 0 ? "#{site}: unchanged ×#{seen[1]}\n#{message}" : message
+        elsif (seen[1] += 1) % EVERY == 0
+            "#{site}: unchanged ×#{seen[1]}"
+        end
+    }
+}.call).(SITE, (VALUE))&.then { |message| PUTS(message) }"""
+
+# GLOBAL is globalThis, or (globalThis as any) in typescript
+JAVASCRIPT_CHANGE_PROBE = r"""((message) => message && PUTS(message))((GLOBAL.__textDebuggingChange = GLOBAL.__textDebuggingChange || ((last) => (PARAMS) => {
+    let text;
+    try {
+        text = JSON.stringify(value);
+    } catch (e) {
+        text = String(value);
+    }
+    const seen = last.get(site);
+    if (!seen || seen[0] !== text) {
+        last.set(site, [text, 0]);
+        const message = site + ': ' + (text === undefined ? String(value) : text);
+        return seen && seen[1] % EVERY !== 0 ? site + ': unchanged ×' + seen[1] + '\n' + message : message;
+    }
+    seen[1] += 1;
+    if (seen[1] % EVERY === 0) {
+        return site + ': unchanged ×' + seen[1];
+    }
+    return null;
+})(new Map()))(SITE, (VALUE)));"""
+
+PHP_CHANGE_PROBE = r"""if (($__td_message = ($GLOBALS['__text_debugging_change'] ??= function ($site, $value) {
+    static $last = [];
+    $text = print_r($value, true);
+    $hash = crc32($text);
+    if (!isset($last[$site]) || $last[$site][0] !== $hash) {
+        $message = "$site: $text";
+        if (isset($last[$site]) && $last[$site][1] % EVERY !== 0) {
+            $message = "$site: unchanged ×{$last[$site][1]}\n$message";
+        }
+        $last[$site] = [$hash, 0];
+        return $message;
+    }
+    if (++$last[$site][1] % EVERY === 0) {
+        return "$site: unchanged ×{$last[$site][1]}";
+    }
+    return null;
+})(SITE, (VALUE))) !== null) {
+    PUTS($__td_message);
+}"""
+
+# like buffered probes, java keeps the state of a site in a local class (Java 16)
+JAVA_CHANGE_PROBE = r"""{
+    class _TdChange {
+        static final long[] seen = {0, -1};
+    }
+    String _tdText = String.valueOf(VALUE);
+    String _tdMessage = null;
+    synchronized (_TdChange.seen) {
+        if (_TdChange.seen[1] < 0 || _TdChange.seen[0] != _tdText.hashCode()) {
+            _tdMessage = SITE + ": " + _tdText;
+            if (_TdChange.seen[1] % EVERY > 0) _tdMessage = SITE + ": unchanged ×" + _TdChange.seen[1] + "\n" + _tdMessage;
+            _TdChange.seen[0] = _tdText.hashCode();
+            _TdChange.seen[1] = 0;
+        } else if (++_TdChange.seen[1] % EVERY == 0) {
+            _tdMessage = SITE + ": unchanged ×" + _TdChange.seen[1];
+        }
+    }
+    if (_tdMessage != null) PUTS(_tdMessage);
+}"""
+
+SWIFT_CHANGE_PROBE = r"""do {
+    let __tdText = String(describing: VALUE)
+    let __tdKey = "text_debugging " + SITE
+    let __tdSeen = Thread.current.threadDictionary[__tdKey] as? [Int] ?? []
+    if __tdSeen.first != __tdText.hashValue {
+        if __tdSeen.count == 2 && __tdSeen[1] % EVERY != 0 {
+            PUTS(SITE + ": unchanged ×\(__tdSeen[1])")
+        }
+        Thread.current.threadDictionary[__tdKey] = [__tdText.hashValue, 0]
+        PUTS(SITE + ": " + __tdText)
+    } else {
+        let __tdSame = __tdSeen[1] + 1
+        Thread.current.threadDictionary[__tdKey] = [__tdSeen[0], __tdSame]
+        if __tdSame % EVERY == 0 {
+            PUTS(SITE + ": unchanged ×\(__tdSame)")
+        }
+    }
+}"""
+
+ELIXIR_CHANGE_PROBE = r"""(fn value ->
+    key = {:text_debugging_changes, SITE}
+    hash = :erlang.phash2(value)
+    case Process.get(key) do
+        {^hash, same} when rem(same + 1, EVERY) == 0 ->
+            Process.put(key, {hash, same + 1})
+            PUTS(SITE <> ": unchanged ×#{same + 1}")
+        {^hash, same} ->
+            Process.put(key, {hash, same + 1})
+        {_, same} when rem(same, EVERY) != 0 ->
+            Process.put(key, {hash, 0})
+            PUTS(SITE <> ": unchanged ×#{same}")
+            PUTS(SITE <> ": #{inspect(value)}")
+        _ ->
+            Process.put(key, {hash, 0})
+            PUTS(SITE <> ": #{inspect(value)}")
+    end
+end).(VALUE)"""
+
+OBJC_CHANGE_PROBE = r"""{
+    static BOOL __tdSeen;
+    static NSUInteger __tdHash, __tdSame;
+    NSString *__tdText = [NSString stringWithFormat:@"%@", VALUE];
+    if (!__tdSeen || __tdText.hash != __tdHash) {
+        if (__tdSeen && __tdSame % EVERY != 0) {
+            PUTS(@"%@: unchanged ×%lu", SITE, (unsigned long)__tdSame);
+        }
+        __tdSeen = YES;
+        __tdHash = __tdText.hash;
+        __tdSame = 0;
+        PUTS(@"%@: %@", SITE, __tdText);
+    } else if (++__tdSame % EVERY == 0) {
+        PUTS(@"%@: unchanged ×%lu", SITE, (unsigned long)__tdSame);
+    }
+}"""
+
+ARDUINO_CHANGE_PROBE = r"""{
+    static bool __tdSeen = false;
+    static unsigned long __tdSame = 0;
+    auto __tdValue = (VALUE);
+    static decltype(__tdValue) __tdLast;
+    if (!__tdSeen || !(__tdLast == __tdValue)) {
+        if (__tdSeen && __tdSame % EVERY != 0) {
+            PUT(SITE ": unchanged ×");
+            PUTS(__tdSame);
+        }
+        __tdSeen = true;
+        __tdLast = __tdValue;
+        __tdSame = 0;
+        PUT(SITE ": ");
+        PUTS(__tdValue);
+    } else if (++__tdSame % EVERY == 0) {
+        PUT(SITE ": unchanged ×");
+        PUTS(__tdSame);
+    }
+}"""
+
+SHELL_CHANGE_PROBE = r"""__td_value="x"VALUE
+if [ "${__td_last_KEY-}" != "$__td_value" ]; then
+    if [ $((${__td_same_KEY:-0} % EVERY)) -ne 0 ]; then
+        PUTS SITE": unchanged ×$__td_same_KEY"
+    fi
+    __td_last_KEY=$__td_value
+    __td_same_KEY=0
+    PUTS SITE": ${__td_value#x}"
+else
+    __td_same_KEY=$((__td_same_KEY + 1))
+    if [ $((__td_same_KEY % EVERY)) -eq 0 ]; then
+        PUTS SITE": unchanged ×$__td_same_KEY"
+    fi
+fi"""
+
+LUA_CHANGE_PROBE = r"""do
+    local message = (__text_debugging_change or (function(last)
+        __text_debugging_change = function(site, value)
+            local text = tostring(value)
+            local seen = last[site]
+            if not seen or seen[1] ~= text then
+                last[site] = {text, 0}
+                local message = site .. ": " .. text
+                if seen and seen[2] % EVERY ~= 0 then
+                    message = site .. ": unchanged ×" .. seen[2] .. "\n" .. message
+                end
+                return message
+            end
+            seen[2] = seen[2] + 1
+            if seen[2] % EVERY == 0 then
+                return site .. ": unchanged ×" .. seen[2]
+            end
+        end
+        return __text_debugging_change
+    end)({}))(SITE, (VALUE))
+    if message then PUTS(message) end
+end"""
+
+
+def c_string(text):
+    return json.dumps(text, ensure_ascii=False)
+
+
+def ruby_string(text):
+    return c_string(text).replace('#', '\\#')
+
+
+def php_string(text):
+    return "'" + text.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def shell_string(text):
+    return "'" + text.replace("'", "'\\''") + "'"
+
+
+def fill_template(template, tab, **values):
+    """
+    Re-indents ``template`` using ``tab``, and replaces its upper case
+    placeholders (``SITE``, ``VALUE``, ...) with ``values``.  This is done in
+    one pass, so the values are never searched for placeholders themselves.
+    """
+    template = re.sub(r'(?m)^(?:    )+', lambda match: tab * (len(match.group(0)) // 4), template)
+    return re.sub(r'(?<![A-Za-z0-9])({0})(?![A-Za-z0-9])'.format('|'.join(values)), lambda match: str(values[match.group(1)]), template)
+
+
+# if generating takes longer than a frame, show a progress indicator
+PROGRESS_DELAY = 16
+STATUS_KEY = 'text_debugging'
+
+
+class TextDebuggingLanguage(object):
+    """
+    Mixin of the language commands; it is not a command itself, so that it is
+    not registered as ``text_debugging``.  The selections are read and the
+    debug output is built by ``generate()`` on the async thread, so that large
+    selections do not freeze the editor.  The output is then inserted by
+    ``text_debugging_insert``, as long as the buffer did not change meanwhile.
+
+    ``generate(regions, tab, ...)`` returns ``(inserts, error)``, where
+    ``inserts`` is a list of ``(point, text)`` in the order they should be
+    inserted; it may be followed by a dict of more arguments for
+    ``text_debugging_insert``.  Commands that support other kinds of probes
+    than ``print`` list them in ``modes``, and receive the ``mode`` argument.
+    The ``changes`` mode is handled by ``generate_changes()`` instead.
+    """
+    modes = ('print',)
+
+    def run(self, edit, mode='print', **kwargs):
+        view = self.view
+        if mode not in self.modes:
+            view.show_popup('No support for {0} probes in the current language grammar.'.format(mode))
+            return
+
+        generate_output = self.generate
+        if mode == 'changes':
+            generate_output = self.generate_changes
+        elif mode != 'print':
+            kwargs['mode'] = mode
+
+        regions = list(view.sel())
+        change_count = view.change_count()
+        state = {'done': False}
+
+        def show_progress():
+            if not state['done']:
+                view.set_status(STATUS_KEY, 'TextDebugging: generating…')
+
+        def finish(inserts, error, args):
+            state['done'] = True
+            view.erase_status(STATUS_KEY)
+            if error:
+                view.show_popup(error)
+                return
+
+            args.update({
+                'change_count': change_count,
+                'inserts': inserts,
+                'selections': [[region.a, region.b] for region in regions if region],
+            })
+            view.run_command('text_debugging_insert', args)
+
+        def generate():
+            try:
+                output = generate_output(regions, **kwargs)
+            except Exception as e:
+                traceback.print_exc()
+                message = 'TextDebugging: {0}'.format(e)
+                sublime.set_timeout(lambda: finish([], message, {}), 0)
+                return
+
+            inserts, error = output[:2]
+            args = output[2] if len(output) > 2 else {}
+            sublime.set_timeout(lambda: finish(inserts, error, args), 0)
+
+        sublime.set_timeout(show_progress, PROGRESS_DELAY)
+        sublime.set_timeout_async(generate, 0)
+
+    def generate_changes(self, regions, tab, **kwargs):
+        """
+        Builds change-only probes, one per selection.  ``change_probe(site,
+        selection, tab, every, ...)`` returns the code that prints the value of
+        ``selection`` only when it differs from the last time that the probe
+        at ``site`` ran.
+        """
+        error = None
+        inserts = []
+        empty_regions = []
+        selections = []
+        for region in regions:
+            if not region:
+                empty_regions.append(region)
+            else:
+                selections.append(self.view.substr(region))
+
+        # any edits that are performed will happen in reverse; this makes it
+        # easy to keep region.a and region.b pointing to the correct locations
+        def get_end(region):
+            return region.end()
+        empty_regions.sort(key=get_end, reverse=True)
+
+        if not empty_regions:
+            error = 'You must place an empty cursor somewhere'
+        elif not selections:
+            error = 'Select the expressions that should be watched for changes'
+        else:
+            if self.view.file_name():
+                name = os.path.basename(self.view.file_name())
+            elif self.view.name():
+                name = self.view.name()
+            else:
+                name = 'Untitled'
+
+            every = self.view.settings().get('text_debugging_unchanged_every') or UNCHANGED_EVERY
+            for empty in empty_regions:
+                indent = indent_at(self.view, empty)
+                line_no = self.view.rowcol(empty.a)[0] + 1
+                output = ''
+                for selection in selections:
+                    site = '{name}:{line_no} {selection}'.format(name=name, line_no=line_no, selection=selection.strip())
+                    if output:
+                        output += "\n"
+                    output += self.change_probe(site, selection, tab, every, **kwargs)
+                line_output = output.replace("\n", "\n{0}".format(indent))
+                inserts.append((empty.a, line_output))
+
+        return inserts, error
+
+
+class TextDebuggingInsert(sublime_plugin.TextCommand):
+    def run(self, edit, change_count, inserts, selections, arduino_probes=()):
+        if self.view.change_count() != change_count:
+            for path, probe_id, probe in arduino_probes:
+                release_arduino_probe_id(path, probe_id)
+            sublime.status_message('TextDebugging: the buffer changed, debug output was discarded')
+            return
+
+        for a, b in selections:
+            self.view.sel().subtract(sublime.Region(a, b))
+
+        for point, text in inserts:
+            self.view.insert(edit, point, text)
+
+        for path, probe_id, probe in arduino_probes:
+            register_arduino_probe(path, probe_id, probe)
+
+
 class TextDebugging(sublime_plugin.TextCommand):
     def run(self, edit, **kwargs):
         if not len(self.view.sel()):
@@ -59,13 +590,23 @@ class TextDebugging(sublime_plugin.TextCommand):
         self.view.show_popup('No support for the current language grammar.')
 
 
-class TextDebuggingPython(sublime_plugin.TextCommand):
-    def run(self, edit, tab, puts="print"):
+class TextDebuggingPython(TextDebuggingLanguage, sublime_plugin.TextCommand):
+    modes = ('print', 'buffered', 'changes')
+
+    def change_probe(self, site, selection, tab, every, puts="print"):
+        helper = fill_template(PYTHON_CHANGE_HELPER, '    ', EVERY=every)
+        return fill_template(PYTHON_CHANGE_PROBE, tab, PUTS=puts, HELPER=repr(helper), SITE=repr(site), VALUE=selection)
+
+    def generate(self, regions, tab, puts="print", mode='print'):
+        if mode == 'buffered':
+            probe = buffered_probe(self.view, PYTHON_BUFFERED_PROBE)
+            puts = "(getattr(__import__('builtins'), '_text_debugging_probe', None) or exec({0!r}, {{}}) or __import__('builtins')._text_debugging_probe)".format(probe)
+
         error = None
+        inserts = []
         empty_regions = []
         debug = ''
         debug_vars = []
-        regions = list(self.view.sel())
         for region in regions:
             if not region:
                 empty_regions.append(region)
@@ -75,11 +616,10 @@ class TextDebuggingPython(sublime_plugin.TextCommand):
                     debug += "\n"
                 debug += "{selection}: {{{count}!r}}".format(selection=selection, count=1 + len(debug_vars))
                 debug_vars.append(selection)
-                self.view.sel().subtract(region)
 
         if not empty_regions:
-            self.view.show_popup('You must place an empty cursor somewhere')
-            return
+            error = 'You must place an empty cursor somewhere'
+            return inserts, error
 
         # any edits that are performed will happen in reverse; this makes it
         # easy to keep region.a and region.b pointing to the correct locations
@@ -105,18 +645,25 @@ class TextDebuggingPython(sublime_plugin.TextCommand):
             output = puts + '("=========== {name} at line {{0}} ===========".format(__import__(\'sys\')._getframe().f_lineno))'.format(name=name)
 
         for empty in empty_regions:
-            self.view.insert(edit, empty.a, output)
+            inserts.append((empty.a, output))
+
+        return inserts, error
+
+
+class TextDebuggingRuby(TextDebuggingLanguage, sublime_plugin.TextCommand):
+    modes = ('print', 'buffered', 'changes')
 
-        if error:
-            self.view.show_popup(error)
+    def change_probe(self, site, selection, tab, every, puts="puts"):
+        return fill_template(RUBY_CHANGE_PROBE, tab, PUTS=puts, EVERY=every, SITE=ruby_string(site), VALUE=selection)
 
+    def generate(self, regions, tab, puts="puts", mode='print'):
+        if mode == 'buffered':
+            puts = buffered_probe(self.view, RUBY_BUFFERED_PROBE, tab)
 
-class TextDebuggingRuby(sublime_plugin.TextCommand):
-    def run(self, edit, tab, puts="puts"):
         error = None
+        inserts = []
         empty_regions = []
         debug = ''
-        regions = list(self.view.sel())
         for region in regions:
             if not region:
                 empty_regions.append(region)
@@ -129,7 +676,6 @@ class TextDebuggingRuby(sublime_plugin.TextCommand):
                 else:
                     var = selection
                 debug += '''  "{selection}: #{{{var}.inspect}}"'''.format(selection=selection.replace('"', r'\"'), var=var)
-                self.view.sel().subtract(region)
 
         # any edits that are performed will happen in reverse; this makes it
         # easy to keep region.a and region.b pointing to the correct locations
@@ -138,7 +684,7 @@ class TextDebuggingRuby(sublime_plugin.TextCommand):
         empty_regions.sort(key=get_end, reverse=True)
 
         if not empty_regions:
-            self.view.show_popup('You must place an empty cursor somewhere')
+            error = 'You must place an empty cursor somewhere'
         else:
             if self.view.file_name():
                 name = os.path.basename(self.view.file_name())
@@ -147,32 +693,42 @@ class TextDebuggingRuby(sublime_plugin.TextCommand):
             else:
                 name = 'Untitled'
 
-            output = puts + '('
-            if debug:
-                output += '["=========== {name} line #{{__LINE__}} ===========",'.format(name=name)
-                output += '\n  "=========== #{self.class == Class ? self.name + \'##\' : self.class.name + \'#\'}#{__method__} ===========",\n'
-                output += debug
-                output += ']'
-            else:
-                output += '"=========== {name} line #{{__LINE__}} ==========="'.format(name=name)
-            output += ')'
-
             for empty in empty_regions:
+                if mode == 'buffered':
+                    # __LINE__ would be the last line of the (long) probe
+                    line = str(self.view.rowcol(empty.a)[0] + 1)
+                else:
+                    line = '#{__LINE__}'
+
+                output = puts + '('
+                if debug:
+                    output += '["=========== {name} line {line} ===========",'.format(name=name, line=line)
+                    output += '\n  "=========== #{self.class == Class ? self.name + \'##\' : self.class.name + \'#\'}#{__method__} ===========",\n'
+                    output += debug
+                    output += ']'
+                else:
+                    output += '"=========== {name} line {line} ==========="'.format(name=name, line=line)
+                output += ')'
+
                 indent = indent_at(self.view, empty)
                 line_output = output.replace("\n", "\n{0}".format(indent))
-                self.view.insert(edit, empty.a, line_output)
+                inserts.append((empty.a, line_output))
+
+        return inserts, error
+
 
-        if error:
-            self.view.show_popup(error)
+class TextDebuggingSwift(TextDebuggingLanguage, sublime_plugin.TextCommand):
+    modes = ('print', 'changes')
 
+    def change_probe(self, site, selection, tab, every, puts="print"):
+        return fill_template(SWIFT_CHANGE_PROBE, tab, PUTS=puts, EVERY=every, SITE=c_string(site), VALUE=selection)
 
-class TextDebuggingSwift(sublime_plugin.TextCommand):
-    def run(self, edit, tab, puts="print"):
+    def generate(self, regions, tab, puts="print"):
         error = None
+        inserts = []
         empty_regions = []
         debug = ''
         debug_vars = []
-        regions = list(self.view.sel())
 
         for region in regions:
             if not region:
@@ -184,7 +740,6 @@ class TextDebuggingSwift(sublime_plugin.TextCommand):
                 else:
                     var = selection
                 debug_vars.append((selection, var))
-                self.view.sel().subtract(region)
 
         # any edits that are performed will happen in reverse; this makes it
         # easy to keep region.a and region.b pointing to the correct locations
@@ -193,7 +748,7 @@ class TextDebuggingSwift(sublime_plugin.TextCommand):
         empty_regions.sort(key=get_end, reverse=True)
 
         if not empty_regions:
-            self.view.show_popup('You must place an empty cursor somewhere')
+            error = 'You must place an empty cursor somewhere'
         else:
             for (selection, var) in debug_vars:
                 if debug:
@@ -207,20 +762,24 @@ class TextDebuggingSwift(sublime_plugin.TextCommand):
             for empty in empty_regions:
                 indent = indent_at(self.view, empty)
                 line_output = output.replace("\n", "\n{0}".format(indent))
-                self.view.insert(edit, empty.a, line_output)
+                inserts.append((empty.a, line_output))
 
-        if error:
-            self.view.show_popup(error)
+        return inserts, error
 
 
 
-class TextDebuggingElixir(sublime_plugin.TextCommand):
-    def run(self, edit, tab, puts="IO.puts"):
+class TextDebuggingElixir(TextDebuggingLanguage, sublime_plugin.TextCommand):
+    modes = ('print', 'changes')
+
+    def change_probe(self, site, selection, tab, every, puts="IO.puts"):
+        return fill_template(ELIXIR_CHANGE_PROBE, tab, PUTS=puts, EVERY=every, SITE=ruby_string(site), VALUE=selection)
+
+    def generate(self, regions, tab, puts="IO.puts"):
         error = None
+        inserts = []
         empty_regions = []
         debug = ''
         debug_vars = []
-        regions = list(self.view.sel())
 
         for region in regions:
             if not region:
@@ -232,7 +791,6 @@ class TextDebuggingElixir(sublime_plugin.TextCommand):
                 else:
                     var = selection
                 debug_vars.append((selection, var))
-                self.view.sel().subtract(region)
 
         # any edits that are performed will happen in reverse; this makes it
         # easy to keep region.a and region.b pointing to the correct locations
@@ -241,7 +799,7 @@ class TextDebuggingElixir(sublime_plugin.TextCommand):
         empty_regions.sort(key=get_end, reverse=True)
 
         if not empty_regions:
-            self.view.show_popup('You must place an empty cursor somewhere')
+            error = 'You must place an empty cursor somewhere'
         else:
             for (selection, var) in debug_vars:
                 if debug:
@@ -255,19 +813,23 @@ class TextDebuggingElixir(sublime_plugin.TextCommand):
             for empty in empty_regions:
                 indent = indent_at(self.view, empty)
                 line_output = output.replace("\n", "\n{0}".format(indent))
-                self.view.insert(edit, empty.a, line_output)
+                inserts.append((empty.a, line_output))
+
+        return inserts, error
+
 
-        if error:
-            self.view.show_popup(error)
+class TextDebuggingObjc(TextDebuggingLanguage, sublime_plugin.TextCommand):
+    modes = ('print', 'changes')
 
+    def change_probe(self, site, selection, tab, every, puts="NSLog"):
+        return fill_template(OBJC_CHANGE_PROBE, tab, PUTS=puts, EVERY=every, SITE='@' + c_string(site), VALUE=selection)
 
-class TextDebuggingObjc(sublime_plugin.TextCommand):
-    def run(self, edit, tab, puts="NSLog"):
+    def generate(self, regions, tab, puts="NSLog"):
         error = None
+        inserts = []
         empty_regions = []
         debug = ''
         debug_vars = ''
-        regions = list(self.view.sel())
         not_empty_regions = 0
         for region in regions:
             if region:
@@ -284,7 +846,6 @@ class TextDebuggingObjc(sublime_plugin.TextCommand):
                 debug_vars += ", "
                 debug += "{selection}: %@".format(selection=selection.replace('"', r'\"'))
                 debug_vars += selection
-                self.view.sel().subtract(region)
         if not debug_vars:
             debug_vars = ', __PRETTY_FUNCTION__, __LINE__'
 
@@ -295,7 +856,7 @@ class TextDebuggingObjc(sublime_plugin.TextCommand):
         empty_regions.sort(key=get_end, reverse=True)
 
         if not empty_regions:
-            self.view.show_popup('You must place an empty cursor somewhere')
+            error = 'You must place an empty cursor somewhere'
         else:
             if self.view.file_name():
                 name = os.path.basename(self.view.file_name())
@@ -311,18 +872,30 @@ class TextDebuggingObjc(sublime_plugin.TextCommand):
             output += ");"
 
             for empty in empty_regions:
-                self.view.insert(edit, empty.a, output)
+                inserts.append((empty.a, output))
 
-        if error:
-            self.view.show_popup(error)
+        return inserts, error
 
 
-class TextDebuggingJavascript(sublime_plugin.TextCommand):
-    def run(self, edit, tab, puts="console.log"):
+class TextDebuggingJavascript(TextDebuggingLanguage, sublime_plugin.TextCommand):
+    modes = ('print', 'changes')
+
+    def generate_changes(self, regions, tab, **kwargs):
+        kwargs['typescript'] = bool(regions) and self.view.score_selector(regions[0].begin(), 'source.ts, source.tsx') > 0
+        return super(TextDebuggingJavascript, self).generate_changes(regions, tab, **kwargs)
+
+    def change_probe(self, site, selection, tab, every, puts="console.log", typescript=False):
+        if typescript:
+            values = dict(GLOBAL='(globalThis as any)', PARAMS='site: string, value: unknown')
+        else:
+            values = dict(GLOBAL='globalThis', PARAMS='site, value')
+        return fill_template(JAVASCRIPT_CHANGE_PROBE, tab, PUTS=puts, EVERY=every, SITE=c_string(site), VALUE=selection, **values)
+
+    def generate(self, regions, tab, puts="console.log"):
         error = None
+        inserts = []
         empty_regions = []
         debugs = []
-        regions = list(self.view.sel())
         for region in regions:
             if not region:
                 empty_regions.append(region)
@@ -335,7 +908,6 @@ class TextDebuggingJavascript(sublime_plugin.TextCommand):
                 else:
                     s_escaped = selection.replace("'", "\\'")
                     debugs.append("'{s_escaped}': {selection}".format(selection=selection, s_escaped=s_escaped))
-                self.view.sel().subtract(region)
 
         # any edits that are performed will happen in reverse; this makes it
         # easy to keep region.a and region.b pointing to the correct locations
@@ -344,7 +916,7 @@ class TextDebuggingJavascript(sublime_plugin.TextCommand):
         empty_regions.sort(key=get_end, reverse=True)
 
         if not empty_regions:
-            self.view.show_popup('You must place an empty cursor somewhere')
+            error = 'You must place an empty cursor somewhere'
         else:
             if self.view.file_name():
                 name = os.path.basename(self.view.file_name())
@@ -372,18 +944,22 @@ class TextDebuggingJavascript(sublime_plugin.TextCommand):
                 indent = indent_at(self.view, empty)
                 line_no = self.view.rowcol(empty.a)[0] + 1
                 line_output = output.replace("\n", "\n{0}".format(indent)).replace("line_no", str(line_no))
-                self.view.insert(edit, empty.a, line_output)
+                inserts.append((empty.a, line_output))
 
-        if error:
-            self.view.show_popup(error)
+        return inserts, error
 
 
-class TextDebuggingPhp(sublime_plugin.TextCommand):
-    def run(self, edit):
+class TextDebuggingPhp(TextDebuggingLanguage, sublime_plugin.TextCommand):
+    modes = ('print', 'changes')
+
+    def change_probe(self, site, selection, tab, every, puts="error_log"):
+        return fill_template(PHP_CHANGE_PROBE, tab, PUTS=puts, EVERY=every, SITE=php_string(site), VALUE=selection)
+
+    def generate(self, regions, tab, puts="error_log"):
         error = None
+        inserts = []
         empty_regions = []
         debugs = ''
-        regions = list(self.view.sel())
         for region in regions:
             if not region:
                 empty_regions.append(region)
@@ -392,7 +968,6 @@ class TextDebuggingPhp(sublime_plugin.TextCommand):
                 if debugs:
                     debugs += ", "
                 debugs += "'{0}' => {1}".format(selection.replace('\'', '\\\''), selection)
-                self.view.sel().subtract(region)
 
         # any edits that are performed will happen in reverse; this makes it
         # easy to keep region.a and region.b pointing to the correct locations
@@ -401,7 +976,7 @@ class TextDebuggingPhp(sublime_plugin.TextCommand):
         empty_regions.sort(key=get_end, reverse=True)
 
         if not empty_regions:
-            self.view.show_popup('You must place an empty cursor somewhere')
+            error = 'You must place an empty cursor somewhere'
         else:
             if self.view.file_name():
                 name = os.path.basename(self.view.file_name())
@@ -410,36 +985,41 @@ class TextDebuggingPhp(sublime_plugin.TextCommand):
             else:
                 name = 'Untitled'
 
-            output = '''$__LINE__ = __LINE__;error_log("=========== {name} at line $__LINE__ ===========");'''.format(name=name)
+            output = '''$__LINE__ = __LINE__;{puts}("=========== {name} at line $__LINE__ ===========");'''.format(puts=puts, name=name)
             if debugs:
                 output += '''
 ob_start();
 var_dump(array({debugs}));
-array_map('error_log', explode("\\n", ob_get_clean()));
-'''[:-1].format(debugs=debugs)
+array_map('{puts}', explode("\\n", ob_get_clean()));
+'''[:-1].format(puts=puts, debugs=debugs)
 
             for empty in empty_regions:
                 indent = indent_at(self.view, empty)
                 line_output = output.replace("\n", "\n{0}".format(indent))
-                self.view.insert(edit, empty.a, line_output)
+                inserts.append((empty.a, line_output))
+
+        return inserts, error
 
-        if error:
-            self.view.show_popup(error)
 
+class TextDebuggingJava(TextDebuggingLanguage, sublime_plugin.TextCommand):
+    modes = ('print', 'buffered', 'changes')
 
-class TextDebuggingJava(sublime_plugin.TextCommand):
-    def run(self, edit, tab, puts="System.out.println"):
+    def change_probe(self, site, selection, tab, every, puts="System.out.println"):
+        return fill_template(JAVA_CHANGE_PROBE, tab, PUTS=puts, EVERY=every, SITE=c_string(site), VALUE=selection)
+
+    def generate(self, regions, tab, puts="System.out.println", mode='print'):
         error = None
+        inserts = []
         empty_regions = []
         debugs = []
-        regions = list(self.view.sel())
+        messages = []
         for region in regions:
             if not region:
                 empty_regions.append(region)
             else:
                 selection = self.view.substr(region)
                 debugs += ['"{s_escaped}:", {selection}'.format(selection=selection, s_escaped=selection.replace('"', '\\"'))]
-                self.view.sel().subtract(region)
+                messages += ['"\\n{s_escaped}: " + ({selection})'.format(selection=selection, s_escaped=selection.replace('"', '\\"'))]
 
         # any edits that are performed will happen in reverse; this makes it
         # easy to keep region.a and region.b pointing to the correct locations
@@ -448,7 +1028,7 @@ class TextDebuggingJava(sublime_plugin.TextCommand):
         empty_regions.sort(key=get_end, reverse=True)
 
         if not empty_regions:
-            self.view.show_popup('You must place an empty cursor somewhere')
+            error = 'You must place an empty cursor somewhere'
         else:
             if self.view.file_name():
                 name = os.path.basename(self.view.file_name())
@@ -457,36 +1037,38 @@ class TextDebuggingJava(sublime_plugin.TextCommand):
             else:
                 name = 'Untitled'
 
-            output = puts + '("=========== {name} at line line_no ===========");\n'.format(name=name)
-            for debug in debugs:
-                output += puts + "({debug});\n".format(debug=debug)
-            output = output[:-1]
+            if mode == 'buffered':
+                messages.insert(0, '"=========== {name} at line line_no ==========="'.format(name=name))
+                output = buffered_probe(self.view, JAVA_BUFFERED_PROBE, tab, MESSAGE=(' +\n' + tab * 2).join(messages))
+            else:
+                output = puts + '("=========== {name} at line line_no ===========");\n'.format(name=name)
+                for debug in debugs:
+                    output += puts + "({debug});\n".format(debug=debug)
+                output = output[:-1]
 
             for empty in empty_regions:
                 indent = indent_at(self.view, empty)
                 line_no = self.view.rowcol(empty.a)[0] + 1
                 line_output = output.replace("\n", "\n{0}".format(indent)).replace("line_no", str(line_no))
-                self.view.insert(edit, empty.a, line_output)
+                inserts.append((empty.a, line_output))
 
-        if error:
-            self.view.show_popup(error)
+        return inserts, error
 
 
 
 
-class TextDebuggingKotlin(sublime_plugin.TextCommand):
-    def run(self, edit, tab, puts="println"):
+class TextDebuggingKotlin(TextDebuggingLanguage, sublime_plugin.TextCommand):
+    def generate(self, regions, tab, puts="println"):
         error = None
+        inserts = []
         empty_regions = []
         debugs = []
-        regions = list(self.view.sel())
         for region in regions:
             if not region:
                 empty_regions.append(region)
             else:
                 selection = self.view.substr(region)
                 debugs += ['"{s_escaped}: ${{{selection}}}"'.format(selection=selection, s_escaped=selection.replace('"', '\\"'))]
-                self.view.sel().subtract(region)
 
         # any edits that are performed will happen in reverse; this makes it
         # easy to keep region.a and region.b pointing to the correct locations
@@ -495,7 +1077,7 @@ class TextDebuggingKotlin(sublime_plugin.TextCommand):
         empty_regions.sort(key=get_end, reverse=True)
 
         if not empty_regions:
-            self.view.show_popup('You must place an empty cursor somewhere')
+            error = 'You must place an empty cursor somewhere'
         else:
             if self.view.file_name():
                 name = os.path.basename(self.view.file_name())
@@ -513,19 +1095,18 @@ class TextDebuggingKotlin(sublime_plugin.TextCommand):
                 indent = indent_at(self.view, empty)
                 line_no = self.view.rowcol(empty.a)[0] + 1
                 line_output = output.replace("\n", "\n{0}".format(indent)).replace("line_no", str(line_no))
-                self.view.insert(edit, empty.a, line_output)
+                inserts.append((empty.a, line_output))
 
-        if error:
-            self.view.show_popup(error)
+        return inserts, error
 
 
-class TextDebuggingElm(sublime_plugin.TextCommand):
-    def run(self, edit, tab, puts="Debug.log"):
+class TextDebuggingElm(TextDebuggingLanguage, sublime_plugin.TextCommand):
+    def generate(self, regions, tab, puts="Debug.log"):
         error = None
+        inserts = []
         empty_regions = []
         debug = ''
         debug_vars = []
-        regions = list(self.view.sel())
 
         for region in regions:
             if not region:
@@ -537,7 +1118,6 @@ class TextDebuggingElm(sublime_plugin.TextCommand):
                 else:
                     var = selection
                 debug_vars.append((selection, var))
-                self.view.sel().subtract(region)
 
         # any edits that are performed will happen in reverse; this makes it
         # easy to keep region.a and region.b pointing to the correct locations
@@ -546,7 +1126,7 @@ class TextDebuggingElm(sublime_plugin.TextCommand):
         empty_regions.sort(key=get_end, reverse=True)
 
         if not empty_regions:
-            self.view.show_popup('You must place an empty cursor somewhere')
+            error = 'You must place an empty cursor somewhere'
         else:
             for (selection, var) in debug_vars:
                 if debug:
@@ -561,25 +1141,23 @@ class TextDebuggingElm(sublime_plugin.TextCommand):
             for empty in empty_regions:
                 indent = indent_at(self.view, empty)
                 line_output = output.replace("\n", "\n{0}".format(indent))
-                self.view.insert(edit, empty.a, line_output)
+                inserts.append((empty.a, line_output))
 
-        if error:
-            self.view.show_popup(error)
+        return inserts, error
 
 
-class TextDebuggingScala(sublime_plugin.TextCommand):
-    def run(self, edit, tab, puts="println"):
+class TextDebuggingScala(TextDebuggingLanguage, sublime_plugin.TextCommand):
+    def generate(self, regions, tab, puts="println"):
         error = None
+        inserts = []
         empty_regions = []
         debugs = []
-        regions = list(self.view.sel())
         for region in regions:
             if not region:
                 empty_regions.append(region)
             else:
                 selection = self.view.substr(region)
                 debugs += ['selection"{s_escaped}: ${{{selection}}}"'.format(selection=selection, s_escaped=selection.replace('"', '\\"'))]
-                self.view.sel().subtract(region)
 
         # any edits that are performed will happen in reverse; this makes it
         # easy to keep region.a and region.b pointing to the correct locations
@@ -588,7 +1166,7 @@ class TextDebuggingScala(sublime_plugin.TextCommand):
         empty_regions.sort(key=get_end, reverse=True)
 
         if not empty_regions:
-            self.view.show_popup('You must place an empty cursor somewhere')
+            error = 'You must place an empty cursor somewhere'
         else:
             if self.view.file_name():
                 name = os.path.basename(self.view.file_name())
@@ -606,26 +1184,115 @@ class TextDebuggingScala(sublime_plugin.TextCommand):
                 indent = indent_at(self.view, empty)
                 line_no = self.view.rowcol(empty.a)[0] + 1
                 line_output = output.replace("\n", "\n{0}".format(indent)).replace("line_no", str(line_no))
-                self.view.insert(edit, empty.a, line_output)
-
-        if error:
-            self.view.show_popup(error)
-
-
-class TextDebuggingArduino(sublime_plugin.TextCommand):
-    def run(self, edit, tab, puts="Serial.println", put="Serial.print"):
+                inserts.append((empty.a, line_output))
+
+        return inserts, error
+
+
+# compact arduino probes write a frame instead of text, see arduino_frames.  The
+# probe ids refer to a probe table, that is kept with the user's settings so
+# that it outlives the sketch's serial dumps.
+ARDUINO_COMPACT_PROBE = r"""{
+    static const uint8_t __tdFrame[] = {FRAME};
+    uint8_t __tdCheck = CHECK;
+    WRITE(__tdFrame, sizeof(__tdFrame));
+    VALUES
+    WRITE(__tdCheck);
+}"""
+
+ARDUINO_COMPACT_VALUE = r"""auto VAR = (VALUE);
+static_assert(sizeof(VAR) <= LIMIT, "compact probes write values of up to LIMIT bytes");
+WRITE((uint8_t) sizeof(VAR));
+WRITE((const uint8_t *) &VAR, sizeof(VAR));
+__tdCheck += sizeof(VAR);
+for (size_t __tdIndex = 0; __tdIndex < sizeof(VAR); __tdIndex++) {
+    __tdCheck += ((const uint8_t *) &VAR)[__tdIndex];
+}"""
+
+ARDUINO_DECODE_CHUNK_SIZE = 64 * 1024
+
+arduino_probes_lock = threading.Lock()
+# path => the probe ids that were handed out, but not inserted yet
+arduino_reserved_ids = {}
+
+
+def arduino_probes_path(view=None):
+    path = view and view.settings().get('text_debugging_arduino_probes')
+    return path or os.path.join(sublime.packages_path(), 'User', 'TextDebugging', 'arduino_probes.json')
+
+
+def load_arduino_probes(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'probes': {}}
+
+
+def reserve_arduino_probe_id(path):
+    """
+    Returns a probe id that is not used in the probe table at ``path``, nor
+    handed out already.  The probe is only added to the table by
+    ``register_arduino_probe()`` once it was inserted.
+    """
+    with arduino_probes_lock:
+        reserved = arduino_reserved_ids.setdefault(path, set())
+        used = [int(key) for key in load_arduino_probes(path)['probes']]
+        probe_id = max(used + list(reserved) or [0]) + 1
+        reserved.add(probe_id)
+    return probe_id
+
+
+def release_arduino_probe_id(path, probe_id):
+    with arduino_probes_lock:
+        arduino_reserved_ids.get(path, set()).discard(probe_id)
+
+
+def register_arduino_probe(path, probe_id, probe):
+    """
+    Adds ``probe`` (its ``file``, ``line`` and ``expressions``) to the probe
+    table at ``path``, under the ``probe_id`` that was reserved for it.
+    """
+    with arduino_probes_lock:
+        table = load_arduino_probes(path)
+        table['probes'][str(probe_id)] = probe
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(table, f, indent=2)
+        arduino_reserved_ids.get(path, set()).discard(probe_id)
+
+
+class TextDebuggingArduino(TextDebuggingLanguage, sublime_plugin.TextCommand):
+    modes = ('print', 'changes', 'compact')
+
+    def change_probe(self, site, selection, tab, every, puts="Serial.println", put="Serial.print"):
+        return fill_template(ARDUINO_CHANGE_PROBE, tab, PUT=put, PUTS=puts, EVERY=every, SITE=c_string(site), VALUE=selection)
+
+    def compact_probe(self, probe_id, selections, tab, write):
+        header = encode_varint(probe_id)
+        values = []
+        for index, selection in enumerate(selections):
+            values.append(fill_template(ARDUINO_COMPACT_VALUE, tab, WRITE=write, LIMIT=MAX_VALUE_SIZE, VAR='__tdValue{0}'.format(index), VALUE=selection))
+        return fill_template(ARDUINO_COMPACT_PROBE, tab,
+            FRAME=', '.join('0x{0:02X}'.format(byte) for byte in FRAME_MAGIC + header),
+            CHECK='0x{0:02X}'.format(checksum(header)),
+            WRITE=write,
+            VALUES='\n'.join(values).replace('\n', '\n' + tab))
+
+    def generate(self, regions, tab, puts="Serial.println", put="Serial.print", write="Serial.write", mode='print'):
         error = None
+        inserts = []
         empty_regions = []
         debugs = []
-        regions = list(self.view.sel())
+        selections = []
         for region in regions:
             if not region:
                 empty_regions.append(region)
             else:
                 selection = self.view.substr(region)
+                selections.append(selection)
                 debugs += [put + '("{s_escaped} = ");'.format(put=put, s_escaped=selection.replace('"', '\\"'))]
                 debugs += [puts + '({selection});'.format(selection=selection)]
-                self.view.sel().subtract(region)
 
         # any edits that are performed will happen in reverse; this makes it
         # easy to keep region.a and region.b pointing to the correct locations
@@ -634,7 +1301,7 @@ class TextDebuggingArduino(sublime_plugin.TextCommand):
         empty_regions.sort(key=get_end, reverse=True)
 
         if not empty_regions:
-            self.view.show_popup('You must place an empty cursor somewhere')
+            error = 'You must place an empty cursor somewhere'
         else:
             if self.view.file_name():
                 name = os.path.basename(self.view.file_name())
@@ -643,6 +1310,24 @@ class TextDebuggingArduino(sublime_plugin.TextCommand):
             else:
                 name = 'Untitled'
 
+            if mode == 'compact':
+                # the probes are added to the probe table once they are inserted
+                path = arduino_probes_path(self.view)
+                probes = []
+                try:
+                    for empty in empty_regions:
+                        indent = indent_at(self.view, empty)
+                        line_no = self.view.rowcol(empty.a)[0] + 1
+                        probe_id = reserve_arduino_probe_id(path)
+                        probes.append([path, probe_id, {'file': name, 'line': line_no, 'expressions': [selection.strip() for selection in selections]}])
+                        output = self.compact_probe(probe_id, selections, tab, write)
+                        inserts.append((empty.a, output.replace("\n", "\n{0}".format(indent))))
+                except Exception:
+                    for path, probe_id, probe in probes:
+                        release_arduino_probe_id(path, probe_id)
+                    raise
+                return inserts, error, {'arduino_probes': probes}
+
             output = puts + '("=========== {name} at line line_no ===========");\n'.format(name=name)
             for debug in debugs:
                 output += "{debug}\n".format(debug=debug)
@@ -652,18 +1337,27 @@ class TextDebuggingArduino(sublime_plugin.TextCommand):
                 indent = indent_at(self.view, empty)
                 line_no = self.view.rowcol(empty.a)[0] + 1
                 line_output = output.replace("\n", "\n{0}".format(indent)).replace("line_no", str(line_no))
-                self.view.insert(edit, empty.a, line_output)
+                inserts.append((empty.a, line_output))
+
+        return inserts, error
 
-        if error:
-            self.view.show_popup(error)
 
+class TextDebuggingShell(TextDebuggingLanguage, sublime_plugin.TextCommand):
+    modes = ('print', 'changes')
 
-class TextDebuggingShell(sublime_plugin.TextCommand):
-    def run(self, edit, tab, puts="echo"):
+    def change_probe(self, site, selection, tab, every, puts="echo"):
+        selection_var = selection
+        if re.match(r'^\w+$', selection_var) and not selection_var.startswith("$"):
+            selection_var = "$" + selection_var
+        # every probe gets variables of its own to remember the last value
+        key = '{0:08x}'.format(zlib.crc32(site.encode('utf-8')) & 0xffffffff)
+        return fill_template(SHELL_CHANGE_PROBE, tab, PUTS=puts, EVERY=every, KEY=key, SITE=shell_string(site), VALUE=selection_var)
+
+    def generate(self, regions, tab, puts="echo"):
         error = None
+        inserts = []
         empty_regions = []
         debugs = []
-        regions = list(self.view.sel())
         for region in regions:
             if not region:
                 empty_regions.append(region)
@@ -674,7 +1368,6 @@ class TextDebuggingShell(sublime_plugin.TextCommand):
                 if re.match(r'^\w+$', selection_var) and not selection_var.startswith("$"):
                     selection_var = "$" + selection_var
                 debugs += ["'{s_escaped}:' {selection_var}".format(selection_var=selection_var, s_escaped=selection.replace('"', '\\"'))]
-                self.view.sel().subtract(region)
 
         # any edits that are performed will happen in reverse; this makes it
         # easy to keep region.a and region.b pointing to the correct locations
@@ -683,7 +1376,7 @@ class TextDebuggingShell(sublime_plugin.TextCommand):
         empty_regions.sort(key=get_end, reverse=True)
 
         if not empty_regions:
-            self.view.show_popup('You must place an empty cursor somewhere')
+            error = 'You must place an empty cursor somewhere'
         else:
             if self.view.file_name():
                 name = os.path.basename(self.view.file_name())
@@ -701,20 +1394,24 @@ class TextDebuggingShell(sublime_plugin.TextCommand):
                 indent = indent_at(self.view, empty)
                 line_no = self.view.rowcol(empty.a)[0] + 1
                 line_output = output.replace("\n", "\n{0}".format(indent)).replace("line_no", str(line_no))
-                self.view.insert(edit, empty.a, line_output)
+                inserts.append((empty.a, line_output))
+
+        return inserts, error
+
 
-        if error:
-            self.view.show_popup(error)
+class TextDebuggingLua(TextDebuggingLanguage, sublime_plugin.TextCommand):
+    modes = ('print', 'changes')
 
+    def change_probe(self, site, selection, tab, every, puts="print"):
+        return fill_template(LUA_CHANGE_PROBE, tab, PUTS=puts, EVERY=every, SITE=c_string(site), VALUE=selection)
 
-class TextDebuggingLua(sublime_plugin.TextCommand):
-    def run(self, edit, tab, puts="print"):
+    def generate(self, regions, tab, puts="print"):
         error = None
+        inserts = []
         empty_regions = []
 
         debug = ''
         debug_vars = []
-        regions = list(self.view.sel())
 
         for region in regions:
             if not region:
@@ -726,7 +1423,6 @@ class TextDebuggingLua(sublime_plugin.TextCommand):
                 else:
                     var = selection
                 debug_vars.append((selection, var))
-                self.view.sel().subtract(region)
 
         # any edits that are performed will happen in reverse; this makes it
         # easy to keep region.a and region.b pointing to the correct locations
@@ -735,7 +1431,7 @@ class TextDebuggingLua(sublime_plugin.TextCommand):
         empty_regions.sort(key=get_end, reverse=True)
 
         if not empty_regions:
-            self.view.show_popup('You must place an empty cursor somewhere')
+            error = 'You must place an empty cursor somewhere'
         else:
             for (selection, var) in debug_vars:
                 if debug:
@@ -751,7 +1447,180 @@ class TextDebuggingLua(sublime_plugin.TextCommand):
             for empty in empty_regions:
                 indent = indent_at(self.view, empty)
                 line_output = output.replace("\n", "\n{0}".format(indent))
-                self.view.insert(edit, empty.a, line_output)
+                inserts.append((empty.a, line_output))
+
+        return inserts, error
+
+
+class TextDebuggingMergeProbes(sublime_plugin.WindowCommand):
+    """
+    Reads the files written by buffered probes, and shows their records in a
+    new view, merged in timestamp order.
+    """
+    def run(self, clear=False):
+        directory = buffer_dir(self.window.active_view())
+        sublime.set_timeout_async(lambda: self.merge(directory, clear), 0)
+
+    def merge(self, directory, clear):
+        try:
+            paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith('.log')]
+        except OSError:
+            paths = []
+
+        if not paths:
+            sublime.status_message('TextDebugging: no buffered probes in {0}'.format(directory))
+            return
+
+        output = ''
+        start = None
+        scratch = tempfile.mkdtemp(prefix='text_debugging')
+        try:
+            for timestamp, thread, message in merge_buffered_records(paths, scratch):
+                if start is None:
+                    start = timestamp
+                output += '+{0:.3f}ms [thread {1}] {2}\n'.format((timestamp - start) / 1e6, thread, message.rstrip('\n'))
+
+            if clear:
+                for path in paths:
+                    os.remove(path)
+        except OSError as e:
+            message = 'TextDebugging: {0}'.format(e)
+            sublime.set_timeout(lambda: sublime.status_message(message), 0)
+            return
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+        sublime.set_timeout(lambda: self.show(output), 0)
+
+    def show(self, output):
+        view = self.window.new_file()
+        view.set_name('TextDebugging probes')
+        view.set_scratch(True)
+        view.run_command('append', {'characters': output})
+
+
+HEATMAP_KEY = 'text_debugging_heatmap'
+HEATMAP_COLORS = ['bluish', 'greenish', 'yellowish', 'orangish', 'redish']
+
+heatmap_phantoms = {}
+
+
+def view_matches(view, name):
+    if view.file_name():
+        file_name = view.file_name().replace('\\', '/')
+        return file_name == name or file_name.endswith('/' + name)
+    return (view.name() or 'Untitled') == name
+
+
+def clear_heatmap(view):
+    for color in HEATMAP_COLORS:
+        view.erase_regions('{0}_{1}'.format(HEATMAP_KEY, color))
+    phantoms = heatmap_phantoms.pop(view.id(), None)
+    if phantoms:
+        phantoms.update([])
+
+
+class TextDebuggingHeatmap(sublime_plugin.WindowCommand):
+    """
+    Counts how often each probe was hit in a captured log, and annotates the
+    probes in the open views with their hit counts, colored by how hot they
+    are compared to the most frequently hit probe.
+    """
+    def run(self, path=None):
+        if path:
+            self.load(path)
+            return
+
+        view = self.window.active_view()
+        default = view and view.settings().get('text_debugging_log') or ''
+        self.window.show_input_panel('Probe log:', default, self.load, None, None)
+
+    def load(self, path):
+        path = os.path.expanduser(path)
+        sublime.status_message('TextDebugging: reading {0}'.format(path))
+
+        def count():
+            try:
+                counts = dict(probe_hits(path))
+            except OSError as e:
+                message = 'TextDebugging: {0}'.format(e)
+                sublime.set_timeout(lambda: sublime.status_message(message), 0)
+                return
+            sublime.set_timeout(lambda: self.annotate(counts), 0)
+
+        sublime.set_timeout_async(count, 0)
+
+    def annotate(self, counts):
+        hottest = max(counts.values()) if counts else 0
+        for window in sublime.windows():
+            for view in window.views():
+                clear_heatmap(view)
+                lines = {}
+                for (name, line), hits in counts.items():
+                    if line > 0 and view_matches(view, name):
+                        lines[line] = lines.get(line, 0) + hits
+                if lines:
+                    self.annotate_view(view, lines, hottest)
+        sublime.status_message('TextDebugging: {0} probes, {1} hits'.format(len(counts), sum(counts.values())))
+
+    def annotate_view(self, view, lines, hottest):
+        regions = {color: [] for color in HEATMAP_COLORS}
+        phantoms = []
+        for line, hits in sorted(lines.items()):
+            region = view.line(view.text_point(line - 1, 0))
+            color = HEATMAP_COLORS[min(len(HEATMAP_COLORS) - 1, len(HEATMAP_COLORS) * hits // hottest)]
+            regions[color].append(region)
+            content = '<span style="color: var(--{0})">× {1}</span>'.format(color, hits)
+            phantoms.append(sublime.Phantom(sublime.Region(region.end()), content, sublime.LAYOUT_INLINE))
+
+        for color, color_regions in regions.items():
+            if color_regions:
+                key = '{0}_{1}'.format(HEATMAP_KEY, color)
+                view.add_regions(key, color_regions, 'region.' + color, 'dot', sublime.DRAW_NO_FILL | sublime.DRAW_NO_OUTLINE)
+
+        phantom_set = heatmap_phantoms[view.id()] = sublime.PhantomSet(view, HEATMAP_KEY)
+        phantom_set.update(phantoms)
+
+
+class TextDebuggingClearHeatmap(sublime_plugin.WindowCommand):
+    def run(self):
+        for window in sublime.windows():
+            for view in window.views():
+                clear_heatmap(view)
+
+
+class TextDebuggingDecodeArduino(sublime_plugin.WindowCommand):
+    """
+    Decodes the output of compact Arduino probes, captured from the serial
+    port into a file, and shows it in a new view.
+    """
+    def run(self, path=None):
+        if path:
+            self.decode(path)
+            return
+
+        view = self.window.active_view()
+        default = view and view.settings().get('text_debugging_arduino_log') or ''
+        self.window.show_input_panel('Serial dump:', default, self.decode, None, None)
+
+    def decode(self, path):
+        path = os.path.expanduser(path)
+        probes = load_arduino_probes(arduino_probes_path(self.window.active_view()))['probes']
+
+        def decode():
+            try:
+                with open(path, 'rb') as f:
+                    output = decode_chunks(iter(lambda: f.read(ARDUINO_DECODE_CHUNK_SIZE), b''), probes)
+            except OSError as e:
+                message = 'TextDebugging: {0}'.format(e)
+                sublime.set_timeout(lambda: sublime.status_message(message), 0)
+                return
+            sublime.set_timeout(lambda: self.show(output), 0)
+
+        sublime.set_timeout_async(decode, 0)
 
-        if error:
-            self.view.show_popup(error)
+    def show(self, output):
+        view = self.window.new_file()
+        view.set_name('TextDebugging Arduino probes')
+        view.set_scratch(True)
+        view.run_command('append', {'characters': output})